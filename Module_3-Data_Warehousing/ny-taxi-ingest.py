@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 import argparse
 import os
-from io import BytesIO
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import dlt
-import pandas as pd
+import pyarrow.parquet as pq
 import requests
-from dlt.destinations import filesystem
+from google.cloud import bigquery, storage
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 # -------------------------
@@ -24,6 +28,33 @@ BASE_PREFIX = "ny_taxi_data"  # bucket "folder" root for this project
 #   DuckDB:    <DB FILE>  schema=<DATASET> table=<TABLE>
 DATASET = "ny_taxi_raw"
 TABLE = "yellow_tripdata"
+# BigQuery load jobs keep the raw TLC column names (VendorID, ...), so they get their own table
+# instead of replacing the snake_case yellow_tripdata that dlt created (vendor_id, _dlt_id, ...)
+BQ_TABLE = "yellow_tripdata_parquet"
+
+# Months are fetched concurrently; downloads are bound by network RTT, not CPU
+MAX_DOWNLOAD_WORKERS = 8
+
+# Published TLC monthly files never change, so downloads are cached on disk keyed by ETag
+CACHE_DIR = Path(os.environ.get("NY_TAXI_CACHE_DIR", Path.home() / ".cache" / "ny_taxi"))
+
+# Rows per Arrow batch handed to dlt; keeps memory at ~batch size instead of ~file size
+BATCH_ROWS = 200_000
+
+# Resumable-upload chunk size for GCS (must be a multiple of 256 KiB)
+GCS_UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+
+# One pooled session per process: keep-alive reuses the TLS connection across months,
+# and transient CloudFront/GitHub 5xx responses are retried with backoff.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=16,
+        max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504], raise_on_status=False),
+    ),
+)
 
 
 def gcs_url(mode: str) -> str:
@@ -31,40 +62,109 @@ def gcs_url(mode: str) -> str:
     return f"gs://{BUCKET}/{BASE_PREFIX}/{mode}"
 
 
+def gcs_blob_name(uri: str) -> str:
+    # gs://de_zoomcamp_homework/ny_taxi_data/dev/...  ->  ny_taxi_data/dev/...
+    return uri.removeprefix(f"gs://{BUCKET}/")
+
+
 def taxi_urls(year: int, months: range) -> list[str]:
     prefix = "https://d37ci6vzurychx.cloudfront.net/trip-data/yellow_tripdata"
     return [f"{prefix}_{year}-{m:02d}.parquet" for m in months]
 
 
+def probe(url: str) -> str | None:
+    """HEADs url; returns its ETag ("" if the server sends none), or None if the month isn't published (403/404)."""
+    head = SESSION.head(url, timeout=(5, 10))
+    if head.status_code in (403, 404):
+        return None
+    head.raise_for_status()
+    return head.headers.get("ETag", "").removeprefix("W/").strip('"')
+
+
+def available_urls(urls: list[str]) -> dict[str, str]:
+    """
+    Fans out HEAD requests and keeps only the months that exist, mapped to their ETag.
+    Missing months (CloudFront answers 403/404) are skipped without paying for a GET.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_DOWNLOAD_WORKERS, len(urls)))) as ex:
+        etags = list(ex.map(probe, urls))
+
+    found = {}
+    for url, etag in zip(urls, etags):
+        if etag is None:
+            print(f"[WARN] Skipping {url} (not published)")
+        else:
+            found[url] = etag
+    return found
+
+
+def cached_download(url: str, etag: str) -> Path:
+    """
+    Returns a local copy of url under CACHE_DIR, keyed by the ETag from probe().
+    Nothing is fetched when the file is already cached; otherwise the body is
+    streamed to a .tmp file and moved into place atomically.
+    """
+    name = url.rsplit("/", 1)[-1].removesuffix(".parquet")
+    cache_path = CACHE_DIR / (f"{name}-{etag}.parquet" if etag else f"{name}.parquet")
+    if etag and cache_path.exists():
+        return cache_path
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = cache_path.with_name(cache_path.name + ".tmp")
+    try:
+        with SESSION.get(url, stream=True, timeout=(5, 120)) as r:
+            r.raise_for_status()
+            with open(tmp, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+        os.replace(tmp, cache_path)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return cache_path
+
+
+def iter_parquet_batches(path: Path):
+    """Yields Arrow RecordBatches from a local Parquet file without decoding it all at once."""
+    # dlt takes Arrow batches as-is, so skip the pandas conversion entirely
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    yield from parquet_file.iter_batches(batch_size=BATCH_ROWS, use_threads=True)
+
+
 @dlt.resource(name=TABLE, write_disposition="replace")
 def download_parquet(year: int = 2024, start_month: int = 1, end_month: int = 6):
-    """Yields DataFrames month-by-month into a single logical table/resource."""
-    for url in taxi_urls(year, range(start_month, end_month + 1)):
-        r = requests.get(url, timeout=60)
-        r.raise_for_status()
-        df = pd.read_parquet(BytesIO(r.content))
-        yield df
+    """Yields Arrow record batches month-by-month into a single logical table/resource."""
+    urls = taxi_urls(year, range(start_month, end_month + 1))
+    sources = available_urls(urls)
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_DOWNLOAD_WORKERS, len(sources)))) as ex:
+        # map() preserves month order; later months keep downloading while earlier ones are yielded
+        for path in ex.map(cached_download, sources, sources.values()):
+            yield from iter_parquet_batches(path)
 
 
-def run_to_gcs(mode: str, year: int, start_month: int, end_month: int):
+def run_to_gcs(mode: str, year: int, start_month: int, end_month: int) -> list[str]:
     """
-    Writes Parquet outputs to GCS under:
-      gs://<bucket>/<base_prefix>/<mode>/<dataset>/<table>/<load_id>.parquet
+    Copies the monthly source Parquet files to GCS under:
+      gs://<bucket>/<base_prefix>/<mode>/<dataset>/<table>/<load_id>_<source file>.parquet
+
+    The files are already Parquet, so they are uploaded byte-for-byte instead of being
+    decoded and re-encoded by dlt. Returns the gs:// URIs written.
     """
-    # Tell dlt filesystem destination where to write
-    os.environ["DESTINATION__FILESYSTEM__BUCKET_URL"] = gcs_url(mode)
+    load_id = f"{time.time():.6f}"
+    bucket = storage.Client(project=PROJECT_ID).bucket(BUCKET)
 
-    pipe = dlt.pipeline(
-        pipeline_name=f"ny_taxi_to_gcs_{mode}",
-        destination=filesystem(layout="{schema_name}/{table_name}/{load_id}.{ext}"),
-        dataset_name=DATASET,  # becomes the "schema_name" folder in GCS layout
-    )
+    def upload_month(url: str, etag: str) -> str:
+        path = cached_download(url, etag)
+        uri = f"{gcs_url(mode)}/{DATASET}/{TABLE}/{load_id}_{url.rsplit('/', 1)[-1]}"
+        bucket.blob(gcs_blob_name(uri), chunk_size=GCS_UPLOAD_CHUNK_SIZE).upload_from_filename(path)
+        return uri
 
-    info = pipe.run(
-        download_parquet(year=year, start_month=start_month, end_month=end_month),
-        loader_file_format="parquet",
-    )
-    print("GCS load result:", info)
+    urls = taxi_urls(year, range(start_month, end_month + 1))
+    sources = available_urls(urls)
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_DOWNLOAD_WORKERS, len(sources)))) as ex:
+        uris = list(ex.map(upload_month, sources, sources.values()))
+
+    print("GCS upload result:", uris)
+    return uris
 
 
 def run_to_duckdb(mode: str, year: int, start_month: int, end_month: int):
@@ -82,26 +182,35 @@ def run_to_duckdb(mode: str, year: int, start_month: int, end_month: int):
     print("DuckDB load result:", info)
 
 
-def run_to_bigquery(mode: str, year: int, start_month: int, end_month: int):
+def run_to_bigquery(uris: list[str]):
     """
-    Loads the same data into BigQuery:
-      de-zoomcamp-homework.ny_taxi_raw.yellow_tripdata
+    Loads the Parquet files already uploaded by run_to_gcs into BigQuery:
+      de-zoomcamp-homework.ny_taxi_raw.yellow_tripdata_parquet
 
+    BigQuery reads them straight from GCS with a load job, so nothing is downloaded again.
     Requires Google ADC credentials (e.g. GOOGLE_APPLICATION_CREDENTIALS set).
     """
-    # Make the BigQuery project explicit (avoids ambiguity if multiple projects/creds exist)
-    os.environ["DESTINATION__BIGQUERY__CREDENTIALS__PROJECT_ID"] = PROJECT_ID
-    os.environ["DESTINATION__BIGQUERY__LOCATION"] = "EU"
-    # If you created the dataset in EU, keep location consistent (optional but recommended)
-    # os.environ["DESTINATION__BIGQUERY__LOCATION"] = "EU"
+    if not uris:
+        print("BigQuery load skipped: no months were uploaded.")
+        return
 
-    pipe = dlt.pipeline(
-        pipeline_name=f"ny_taxi_to_bigquery_{mode}",
-        destination="bigquery",
-        dataset_name=DATASET,  # BigQuery dataset
+    # Make the BigQuery project explicit (avoids ambiguity if multiple projects/creds exist)
+    client = bigquery.Client(project=PROJECT_ID, location="EU")
+
+    dataset = bigquery.Dataset(f"{PROJECT_ID}.{DATASET}")
+    dataset.location = "EU"
+    client.create_dataset(dataset, exists_ok=True)
+
+    job = client.load_table_from_uri(
+        uris,
+        f"{PROJECT_ID}.{DATASET}.{BQ_TABLE}",
+        job_config=bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,  # same as the resource's "replace"
+        ),
     )
-    info = pipe.run(download_parquet(year=year, start_month=start_month, end_month=end_month))
-    print("BigQuery load result:", info)
+    job.result()
+    print("BigQuery load result:", job.job_id, f"{job.output_rows} rows")
 
 
 def main():
@@ -113,13 +222,13 @@ def main():
     args = ap.parse_args()
 
     # Always write to GCS (dev/prod prefix)
-    run_to_gcs(args.mode, args.year, args.start_month, args.end_month)
+    uris = run_to_gcs(args.mode, args.year, args.start_month, args.end_month)
 
     # Then load to DB depending on mode
     if args.mode == "dev":
         run_to_duckdb(args.mode, args.year, args.start_month, args.end_month)
     else:
-        run_to_bigquery(args.mode, args.year, args.start_month, args.end_month)
+        run_to_bigquery(uris)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 import argparse
 import os
-from io import BytesIO
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import dlt
-import pandas as pd
+import pyarrow.parquet as pq
 import requests
-from dlt.destinations import filesystem
+from google.cloud import bigquery, storage
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 PROJECT_ID = "de-zoomcamp-homework"
 
@@ -16,15 +20,49 @@ BASE_PREFIX = "ny_taxi_data"
 # Keep DB dataset/schema stable
 DATASET = "raw"
 
+# Months are fetched concurrently; downloads are bound by network RTT, not CPU
+MAX_DOWNLOAD_WORKERS = 8
+
+# Published TLC monthly files never change, so downloads are cached on disk keyed by ETag
+CACHE_DIR = Path(os.environ.get("NY_TAXI_CACHE_DIR", Path.home() / ".cache" / "ny_taxi"))
+
+# Rows per Arrow batch handed to dlt; keeps memory at ~batch size instead of ~file size
+BATCH_ROWS = 200_000
+
+# Resumable-upload chunk size for GCS (must be a multiple of 256 KiB)
+GCS_UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+
+# One pooled session per process: keep-alive reuses the TLS connection across months,
+# and transient CloudFront/GitHub 5xx responses are retried with backoff.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=16,
+        max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504], raise_on_status=False),
+    ),
+)
+
 def gcs_url(mode: str) -> str:
     return f"gs://{BUCKET}/{BASE_PREFIX}/{mode}"
 
 
+def gcs_blob_name(uri: str) -> str:
+    return uri.removeprefix(f"gs://{BUCKET}/")
+
+
 def stable_table_name(taxi: str) -> str:
-    # Stable names for DuckDB & BigQuery
+    # Stable names for DuckDB (and the BigQuery tables dlt created earlier)
     return f"{taxi}_tripdata"
 
 
+def bigquery_table_name(taxi: str) -> str:
+    # BigQuery load jobs keep the raw TLC column names (VendorID, ...), so they must not append
+    # into the snake_case {taxi}_tripdata tables dlt created (vendor_id, REQUIRED _dlt_id, ...)
+    return f"{taxi}_tripdata_parquet"
+
+
 def gcs_table_name_with_range(taxi: str, year: int, start_month: int, end_month: int) -> str:
     # Only for GCS filenames/folders (human readable)
     # Example: green_tripdata_202401-202406
@@ -36,53 +74,106 @@ def taxi_urls(taxi: str, year: int, months: range) -> list[str]:
     return [f"{prefix}_{year}-{m:02d}.parquet" for m in months]
 
 
+def probe(url: str) -> str | None:
+    """HEADs url; returns its ETag ("" if the server sends none), or None if the month isn't published (403/404)."""
+    head = SESSION.head(url, timeout=(5, 10))
+    if head.status_code in (403, 404):
+        return None
+    head.raise_for_status()
+    return head.headers.get("ETag", "").removeprefix("W/").strip('"')
+
+
+def available_urls(urls: list[str]) -> dict[str, str]:
+    """
+    Fans out HEAD requests and keeps only the months that exist, mapped to their ETag.
+    Missing months (CloudFront answers 403/404) are skipped without paying for a GET.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_DOWNLOAD_WORKERS, len(urls)))) as ex:
+        etags = list(ex.map(probe, urls))
+
+    found = {}
+    for url, etag in zip(urls, etags):
+        if etag is None:
+            print(f"[WARN] Skipping {url} (not published)")
+        else:
+            found[url] = etag
+    return found
+
+
+def cached_download(url: str, etag: str) -> Path:
+    """
+    Returns a local copy of url under CACHE_DIR, keyed by the ETag from probe().
+    Nothing is fetched when the file is already cached; otherwise the body is
+    streamed to a .tmp file and moved into place atomically.
+    """
+    name = url.rsplit("/", 1)[-1].removesuffix(".parquet")
+    cache_path = CACHE_DIR / (f"{name}-{etag}.parquet" if etag else f"{name}.parquet")
+    if etag and cache_path.exists():
+        return cache_path
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = cache_path.with_name(cache_path.name + ".tmp")
+    try:
+        with SESSION.get(url, stream=True, timeout=(5, 120)) as r:
+            r.raise_for_status()
+            with open(tmp, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+        os.replace(tmp, cache_path)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return cache_path
+
+
+def iter_parquet_batches(path: Path):
+    """Yields Arrow RecordBatches from a local Parquet file without decoding it all at once."""
+    # dlt takes Arrow batches as-is, so skip the pandas conversion entirely
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    yield from parquet_file.iter_batches(batch_size=BATCH_ROWS, use_threads=True)
+
+
 def make_resource(taxi: str, resource_name: str, write_disposition: str, year: int, start_month: int, end_month: int):
     """
     Factory that builds a dlt resource with a caller-controlled name.
-    We use:
-      - stable name for DB destinations
-      - decorated name for GCS destination
+    We use the stable table name for DB destinations.
     """
     @dlt.resource(name=resource_name, write_disposition=write_disposition)
     def _resource():
-        for url in taxi_urls(taxi, year, range(start_month, end_month + 1)):
-            r = requests.get(url, timeout=60)
-            r.raise_for_status()
-            df = pd.read_parquet(BytesIO(r.content))
-            yield df
+        urls = taxi_urls(taxi, year, range(start_month, end_month + 1))
+        sources = available_urls(urls)
+        with ThreadPoolExecutor(max_workers=max(1, min(MAX_DOWNLOAD_WORKERS, len(sources)))) as ex:
+            # map() preserves month order; later months keep downloading while earlier ones are yielded
+            for path in ex.map(cached_download, sources, sources.values()):
+                yield from iter_parquet_batches(path)
 
     return _resource()
 
 
-def run_to_gcs(taxi: str, mode: str, year: int, start_month: int, end_month: int):
+def run_to_gcs(taxi: str, mode: str, year: int, start_month: int, end_month: int) -> list[str]:
     """
     GCS naming convention:
-      gs://<bucket>/<base_prefix>/<mode>/<dataset>/<stable_table>/<load_id>_<YYYYMM-YYYYMM>.parquet
+      gs://<bucket>/<base_prefix>/<mode>/<dataset>/<table>_<YYYYMM-YYYYMM>/<load_id>_<source file>.parquet
 
-    Folder stays: raw/<green_tripdata|yellow_tripdata>/
-    Filename includes: load_id + date range
+    The source files are already Parquet, so each month is copied to GCS byte-for-byte
+    (no dlt normalize / re-encode). Returns the gs:// URIs written.
     """
-    os.environ["DESTINATION__FILESYSTEM__BUCKET_URL"] = gcs_url(mode)
-
     gcs_name = gcs_table_name_with_range(taxi, year, start_month, end_month)
+    load_id = f"{time.time():.6f}"
+    bucket = storage.Client(project=PROJECT_ID).bucket(BUCKET)
 
-    pipe = dlt.pipeline(
-        pipeline_name=f"ny_taxi_to_gcs_{mode}",
-        destination=filesystem(layout="{schema_name}/{table_name}/{load_id}_{table_name}.{ext}"),
-        dataset_name=DATASET,
-    )
+    def upload_month(url: str, etag: str) -> str:
+        path = cached_download(url, etag)
+        uri = f"{gcs_url(mode)}/{DATASET}/{gcs_name}/{load_id}_{url.rsplit('/', 1)[-1]}"
+        bucket.blob(gcs_blob_name(uri), chunk_size=GCS_UPLOAD_CHUNK_SIZE).upload_from_filename(path)
+        return uri
 
-    gcs_resource = make_resource(
-        taxi=taxi,
-        resource_name=gcs_name,          # ONLY affects GCS
-        write_disposition="append",      # doesn't really "append files"; it creates new load packages
-        year=year,
-        start_month=start_month,
-        end_month=end_month,
-    )
+    urls = taxi_urls(taxi, year, range(start_month, end_month + 1))
+    sources = available_urls(urls)
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_DOWNLOAD_WORKERS, len(sources)))) as ex:
+        uris = list(ex.map(upload_month, sources, sources.values()))
 
-    info = pipe.run(gcs_resource, loader_file_format="parquet")
-    print("GCS load result:", info)
+    print("GCS upload result:", uris)
+    return uris
 
 
 def run_to_duckdb(taxi: str, mode: str, year: int, start_month: int, end_month: int):
@@ -111,32 +202,40 @@ def run_to_duckdb(taxi: str, mode: str, year: int, start_month: int, end_month:
     print("DuckDB load result:", info)
 
 
-def run_to_bigquery(taxi: str, mode: str, year: int, start_month: int, end_month: int):
+def run_to_bigquery(taxi: str, uris: list[str]):
     """
     BigQuery:
-      de-zoomcamp-homework.raw.green_tripdata OR yellow_tripdata
+      de-zoomcamp-homework.raw.green_tripdata_parquet OR yellow_tripdata_parquet
       disposition = append
-    """
-    os.environ["DESTINATION__BIGQUERY__CREDENTIALS__PROJECT_ID"] = PROJECT_ID
-    os.environ["DESTINATION__BIGQUERY__LOCATION"] = "EU"
 
-    pipe = dlt.pipeline(
-        pipeline_name=f"ny_taxi_to_bigquery_{mode}",
-        destination="bigquery",
-        dataset_name=DATASET,
-    )
-
-    bq_resource = make_resource(
-        taxi=taxi,
-        resource_name=stable_table_name(taxi),  # stable table name
-        write_disposition="append",
-        year=year,
-        start_month=start_month,
-        end_month=end_month,
+    Loads the Parquet files run_to_gcs already uploaded via a BigQuery load job,
+    so nothing is downloaded a second time.
+    """
+    if not uris:
+        print("BigQuery load skipped: no months were uploaded.")
+        return
+
+    client = bigquery.Client(project=PROJECT_ID, location="EU")
+
+    dataset = bigquery.Dataset(f"{PROJECT_ID}.{DATASET}")
+    dataset.location = "EU"
+    client.create_dataset(dataset, exists_ok=True)
+
+    job = client.load_table_from_uri(
+        uris,
+        f"{PROJECT_ID}.{DATASET}.{bigquery_table_name(taxi)}",
+        job_config=bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            # New months may add columns (e.g. airport_fee) or relax REQUIRED ones
+            schema_update_options=[
+                bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION,
+                bigquery.SchemaUpdateOption.ALLOW_FIELD_RELAXATION,
+            ],
+        ),
     )
-
-    info = pipe.run(bq_resource)
-    print("BigQuery load result:", info)
+    job.result()
+    print("BigQuery load result:", job.job_id, f"{job.output_rows} rows")
 
 
 def main():
@@ -148,12 +247,12 @@ def main():
     ap.add_argument("--end-month", type=int, default=6)
     args = ap.parse_args()
 
-    run_to_gcs(args.taxi, args.mode, args.year, args.start_month, args.end_month)
+    uris = run_to_gcs(args.taxi, args.mode, args.year, args.start_month, args.end_month)
 
     if args.mode == "dev":
         run_to_duckdb(args.taxi, args.mode, args.year, args.start_month, args.end_month)
     else:
-        run_to_bigquery(args.taxi, args.mode, args.year, args.start_month, args.end_month)
+        run_to_bigquery(args.taxi, uris)
 
 
 if __name__ == "__main__":
@@ -1,55 +1,83 @@
+import argparse
 import duckdb
+import os
+import pandas as pd
 import requests
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 from typing import List, Tuple
+from urllib3.util.retry import Retry
 
 BASE_URL = "https://github.com/DataTalksClub/nyc-tlc-data/releases/download"
 RELEASE = "fhv"  # folder name under releases/download
 
+# One pooled session per process: keep-alive reuses the TLS connection across months,
+# and transient GitHub 5xx responses are retried with backoff.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=16,
+        max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504], raise_on_status=False),
+    ),
+)
+
 
 def month_range(start_year: int, start_month: int, end_year: int, end_month: int):
-    """Yield (year, month) tuples from start (inclusive) to end (inclusive)."""
-    y, m = start_year, start_month
-    while (y < end_year) or (y == end_year and m <= end_month):
-        yield y, m
-        m += 1
-        if m == 13:
-            m = 1
-            y += 1
-
-
-def download_file(url: str, dest: Path, chunk_size: int = 8192) -> None:
-    """Download a URL to a destination file."""
-    resp = requests.get(url, stream=True, timeout=60)
-    resp.raise_for_status()
-    with open(dest, "wb") as f:
-        for chunk in resp.iter_content(chunk_size=chunk_size):
-            if chunk:
-                f.write(chunk)
-
-
-def convert_csv_gz_to_parquet(csv_gz_path: Path, parquet_path: Path) -> None:
+    """Return (year, month) tuples from start (inclusive) to end (inclusive)."""
+    months = pd.date_range(f"{start_year}-{start_month:02d}-01", f"{end_year}-{end_month:02d}-01", freq="MS")
+    return [(d.year, d.month) for d in months]
+
+
+def download_file(url: str, dest: Path, chunk_size: int = 16 * 1024 * 1024) -> None:
+    """
+    Download a URL to a destination file.
+    Large read chunks + a buffered writer keep Python-level write calls low.
+    Writes go to <dest>.part and are renamed into place, so dest is never half-written;
+    no explicit fsync, the page cache batches writeback.
     """
-    Convert a gzipped CSV to Parquet using DuckDB.
+    part = dest.with_suffix(dest.suffix + ".part")
+    try:
+        with SESSION.get(url, stream=True, timeout=(5, 120)) as resp:
+            resp.raise_for_status()
+            with open(part, "wb", buffering=chunk_size) as f:
+                for chunk in resp.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        f.write(chunk)
+        os.replace(part, dest)
+    finally:
+        part.unlink(missing_ok=True)
+
+
+def configure_duckdb(con: duckdb.DuckDBPyConnection) -> None:
+    """Use every core and let DuckDB reorder rows freely (row order is irrelevant here)."""
+    con.execute(f"PRAGMA threads={os.cpu_count() or 1}")
+    con.execute("PRAGMA preserve_insertion_order=false")
+
+
+def convert_csv_gz_to_parquet(con: duckdb.DuckDBPyConnection, csv_gz_path: Path, parquet_path: Path) -> None:
+    """
+    Convert a gzipped CSV to Parquet using an existing DuckDB connection.
     Uses tolerant CSV parsing to handle non-UTF8 bytes / malformed rows.
     If conversion fails, deletes any partial Parquet file.
     """
     try:
-        con = duckdb.connect()
+        # Named parameters: with positional ? DuckDB binds the COPY target before the inner query
         con.execute(
-            f"""
+            """
             COPY (
               SELECT * FROM read_csv_auto(
-                '{csv_gz_path}',
+                $source,
                 strict_mode=false,
                 ignore_errors=true,
                 encoding='latin-1'
               )
             )
-            TO '{parquet_path}' (FORMAT PARQUET);
-            """
+            TO $target (FORMAT PARQUET, COMPRESSION ZSTD, COMPRESSION_LEVEL 3, ROW_GROUP_SIZE 512000);
+            """,
+            {"source": str(csv_gz_path), "target": str(parquet_path)},
         )
-        con.close()
     except Exception:
         # If a partial parquet file was created, remove it so future runs don't "skip" it.
         if parquet_path.exists():
@@ -77,6 +105,10 @@ def download_and_convert_fhv_files(
     successes: List[Path] = []
     failures: List[Tuple[str, str]] = []
 
+    # One in-memory connection for every month instead of reconnecting per file
+    con = duckdb.connect(":memory:")
+    configure_duckdb(con)
+
     for year, month in month_range(start_year, start_month, end_year, end_month):
         csv_gz_filename = f"fhv_tripdata_{year}-{month:02d}.csv.gz"
         csv_gz_filepath = data_dir / csv_gz_filename
@@ -107,17 +139,11 @@ def download_and_convert_fhv_files(
             msg = f"download failed: {e}"
             print(f"[WARN] {csv_gz_filename}: {msg}")
             failures.append((csv_gz_filename, msg))
-            # If a partial download exists, remove it
-            if csv_gz_filepath.exists():
-                try:
-                    csv_gz_filepath.unlink()
-                except Exception:
-                    pass
             continue
 
         print(f"Converting {csv_gz_filename} to Parquet...")
         try:
-            convert_csv_gz_to_parquet(csv_gz_filepath, parquet_filepath)
+            convert_csv_gz_to_parquet(con, csv_gz_filepath, parquet_filepath)
             successes.append(parquet_filepath)
             print(f"Completed {parquet_filename}")
         except Exception as e:
@@ -132,6 +158,7 @@ def download_and_convert_fhv_files(
                 except Exception:
                     pass
 
+    con.close()
     return successes, failures
 
 
@@ -146,40 +173,114 @@ def update_gitignore():
 def load_parquets_into_duckdb(db_path: str = "taxi_rides_ny.duckdb") -> None:
     """
     Load all valid FHV Parquets into DuckDB as prod.fhv_tripdata.
-    Skips tiny/broken parquet files.
+    Tiny/broken parquet files are renamed to *.parquet.bad so DuckDB can glob the
+    directory itself and read row groups from all files in parallel.
     """
     fhv_dir = Path("data") / "fhv"
     parquet_files = sorted(fhv_dir.glob("*.parquet"))
 
-    # Heuristic: skip tiny files that are likely partial/broken
-    good_files = [p for p in parquet_files if p.stat().st_size > 1024]
+    # Heuristic: tiny files are likely partial/broken; move them out of the glob's way
+    bad_files = [p for p in parquet_files if p.stat().st_size <= 1024]
+    for p in bad_files:
+        p.replace(p.with_name(p.name + ".bad"))
 
-    print(f"Found {len(parquet_files)} parquet files; loading {len(good_files)} (skipping tiny/broken).")
+    good_count = len(parquet_files) - len(bad_files)
+    print(f"Found {len(parquet_files)} parquet files; loading {good_count} (skipping tiny/broken).")
 
-    if not good_files:
+    if not good_count:
         raise RuntimeError("No valid parquet files found to load. Conversion likely failed for all months.")
 
-    file_list_sql = ", ".join([f"'{str(p)}'" for p in good_files])
-
     con = duckdb.connect(db_path)
+    configure_duckdb(con)
     con.execute("CREATE SCHEMA IF NOT EXISTS prod")
     con.execute(
-        f"""
-        CREATE OR REPLACE TABLE prod.fhv_tripdata AS
-        SELECT * FROM read_parquet([{file_list_sql}], union_by_name=true);
         """
+        CREATE OR REPLACE TABLE prod.fhv_tripdata AS
+        SELECT * FROM read_parquet(?, union_by_name=true);
+        """,
+        [str(fhv_dir / "*.parquet")],
     )
     con.close()
     print("✅ Loaded prod.fhv_tripdata successfully.")
 
 
-if __name__ == "__main__":
-    update_gitignore()
+def stream_fhv_into_duckdb(
+    db_path: str = "taxi_rides_ny.duckdb",
+    start_year: int = 2019,
+    start_month: int = 1,
+    end_year: int = 2021,
+    end_month: int = 7,
+) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """
+    Load FHV CSV.gz files straight from their release URLs into prod.fhv_tripdata via httpfs.
+    No local CSV.gz / Parquet copies are written. Each month is read into a temp table (so a
+    bad month is recorded as a failure instead of sinking the whole run), inserted BY NAME into
+    a scratch table and dropped again, so only one month is staged at a time. Columns a month
+    adds are added to the scratch table; a column whose type drifts is widened to VARCHAR.
+    prod.fhv_tripdata is only replaced by the scratch table if at least one month loaded.
+    Returns (loaded_files, failures[(filename, error)]).
+    """
+    loaded: List[str] = []
+    failures: List[Tuple[str, str]] = []
+    target = "prod.fhv_tripdata__load"
 
-    successes, failures = download_and_convert_fhv_files()
+    con = duckdb.connect(db_path)
+    configure_duckdb(con)
+    con.execute("INSTALL httpfs; LOAD httpfs;")
+    con.execute("CREATE SCHEMA IF NOT EXISTS prod")
+    con.execute(f"DROP TABLE IF EXISTS {target}")
 
+    for year, month in month_range(start_year, start_month, end_year, end_month):
+        csv_gz_filename = f"fhv_tripdata_{year}-{month:02d}.csv.gz"
+        url = f"{BASE_URL}/{RELEASE}/{csv_gz_filename}"
+        print(f"Loading {url}")
+
+        try:
+            con.execute(
+                """
+                CREATE OR REPLACE TEMP TABLE fhv_month AS
+                SELECT * FROM read_csv_auto(
+                  ?,
+                  strict_mode=false,
+                  ignore_errors=true,
+                  encoding='latin-1'
+                )
+                """,
+                [url],
+            )
+            if not loaded:
+                con.execute(f"CREATE TABLE {target} AS SELECT * FROM fhv_month")
+            else:
+                existing = dict(con.execute(f"SELECT column_name, column_type FROM (DESCRIBE {target})").fetchall())
+                for name, col_type in con.execute("SELECT column_name, column_type FROM (DESCRIBE fhv_month)").fetchall():
+                    if name not in existing:
+                        con.execute(f'ALTER TABLE {target} ADD COLUMN "{name}" {col_type}')
+                    elif existing[name] != col_type and existing[name] != "VARCHAR":
+                        con.execute(f'ALTER TABLE {target} ALTER COLUMN "{name}" TYPE VARCHAR')
+                con.execute(f"INSERT INTO {target} BY NAME SELECT * FROM fhv_month")
+            loaded.append(csv_gz_filename)
+        except Exception as e:
+            msg = f"load failed: {e}"
+            print(f"[WARN] {csv_gz_filename}: {msg}")
+            failures.append((csv_gz_filename, msg))
+        finally:
+            con.execute("DROP TABLE IF EXISTS fhv_month")
+
+    if loaded:
+        con.execute("BEGIN TRANSACTION")
+        con.execute("DROP TABLE IF EXISTS prod.fhv_tripdata")
+        con.execute(f"ALTER TABLE {target} RENAME TO fhv_tripdata")
+        con.execute("COMMIT")
+    else:
+        con.execute(f"DROP TABLE IF EXISTS {target}")
+
+    con.close()
+    return loaded, failures
+
+
+def print_summary(label: str, successes: list, failures: List[Tuple[str, str]]) -> None:
     print(f"\n=== Summary ===")
-    print(f"Parquets created/available: {len(successes)}")
+    print(f"{label}: {len(successes)}")
     print(f"Failures: {len(failures)}")
     if failures:
         for fname, err in failures[:10]:
@@ -187,5 +288,27 @@ if __name__ == "__main__":
         if len(failures) > 10:
             print(f" ... and {len(failures) - 10} more")
 
-    # Load whatever valid Parquets exist into DuckDB
-    load_parquets_into_duckdb("taxi_rides_ny.duckdb")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "--via-parquet",
+        action="store_true",
+        help="download + convert to local Parquet under data/fhv first (keeps files for re-runs)",
+    )
+    args = ap.parse_args()
+
+    if not args.via_parquet:
+        loaded, failures = stream_fhv_into_duckdb("taxi_rides_ny.duckdb")
+        print_summary("Months loaded", loaded, failures)
+        if not loaded:
+            raise RuntimeError("No FHV months could be loaded into DuckDB.")
+        print("✅ Loaded prod.fhv_tripdata successfully.")
+    else:
+        update_gitignore()
+
+        successes, failures = download_and_convert_fhv_files()
+        print_summary("Parquets created/available", successes, failures)
+
+        # Load whatever valid Parquets exist into DuckDB
+        load_parquets_into_duckdb("taxi_rides_ny.duckdb")
@@ -23,12 +23,12 @@ connection: duckdb-default
 # - you typically omit the `materialization:` block
 # - you do NOT need a `materialize()` function; you just run Python code
 # Docs: https://getbruin.com/docs/bruin/assets/python#materialization
-materialization:
-  # TODO: choose `table` or `view` (ingestion generally should be a table)
-  type: table
-  # TODO: pick a strategy.
-  # suggested strategy: append
-  strategy: append
+# This asset uses the manual-write approach: each month is appended to ingestion.trips as soon as it is read,
+# so memory stays at one month no matter how long the backfill window is (a returned DataFrame would hold all of it).
+# The DuckDB connection details are injected as JSON through `secrets`.
+secrets:
+  - key: duckdb-default
+    inject_as: DUCKDB_DEFAULT
 
 # TODO: Define output columns (names + types) for metadata, lineage, and quality checks.
 # Tip: mark stable identifiers as `primary_key: true` if you plan to use `merge` later.
@@ -49,94 +49,192 @@ columns:
 # TODO: Add imports needed for your ingestion (e.g., pandas, requests).
 # - Put dependencies in the nearest `requirements.txt` (this template has one at the pipeline root).
 # Docs: https://getbruin.com/docs/bruin/assets/python
-import io
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
+from pathlib import Path
 
+import duckdb
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
 from dateutil import parser
-from dateutil.relativedelta import relativedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 BASE_URL = "https://d37ci6vzurychx.cloudfront.net/trip-data"
 DEFAULT_TAXI_TYPES = ["yellow", "green"]
-EXPECTED_RAW_COLUMNS = [
-    "VendorID",
-    "tpep_pickup_datetime",
-    "lpep_pickup_datetime",
-    "pickup_datetime",
-    "tpep_dropoff_datetime",
-    "lpep_dropoff_datetime",
-    "dropoff_datetime",
-    "PULocationID",
-    "DOLocationID",
-    "payment_type",
-    "passenger_count",
-    "trip_distance",
-    "fare_amount",
-    "total_amount",
+MAX_DOWNLOAD_WORKERS = 8
+# Published TLC monthly files never change, so downloads are cached on disk keyed by ETag.
+CACHE_DIR = Path(os.environ.get("NY_TAXI_CACHE_DIR", Path.home() / ".cache" / "ny_taxi"))
+# One pooled session: keep-alive reuses the TLS connection across months and transient
+# CloudFront 5xx responses are retried with backoff.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=16,
+        max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504], raise_on_status=False),
+    ),
+)
+# Raw columns staging relies on; months/taxi types missing one get an all-null column of this type.
+EXPECTED_SCHEMA = pa.schema(
+    [
+        ("VendorID", pa.int64()),
+        ("tpep_pickup_datetime", pa.timestamp("us")),
+        ("lpep_pickup_datetime", pa.timestamp("us")),
+        ("pickup_datetime", pa.timestamp("us")),
+        ("tpep_dropoff_datetime", pa.timestamp("us")),
+        ("lpep_dropoff_datetime", pa.timestamp("us")),
+        ("dropoff_datetime", pa.timestamp("us")),
+        ("PULocationID", pa.int64()),
+        ("DOLocationID", pa.int64()),
+        ("payment_type", pa.int64()),
+        ("passenger_count", pa.float64()),
+        ("trip_distance", pa.float64()),
+        ("fare_amount", pa.float64()),
+        ("total_amount", pa.float64()),
+    ]
+)
+EXPECTED_RAW_COLUMNS = EXPECTED_SCHEMA.names
+# Lineage columns ingest() adds to every row; ingestion.trips is EXPECTED_SCHEMA followed by these.
+LINEAGE_FIELDS = [
+    pa.field("taxi_type", pa.string()),
+    pa.field("source_url", pa.string()),
+    pa.field("extracted_at", pa.timestamp("us")),
 ]
 
 
-def month_starts(start_date: datetime, end_date: datetime) -> list[datetime]:
-    current = start_date.replace(day=1)
-    results = []
-    while current < end_date:
-        results.append(current)
-        current = current + relativedelta(months=1)
-    return results
+def month_starts(start_date: datetime, end_date: datetime) -> pd.DatetimeIndex:
+    return pd.date_range(start_date.replace(day=1), end_date, freq="MS", inclusive="left")
 
 
-# TODO: Only implement `materialize()` if you are using Bruin Python materialization.
-# If you choose the manual-write approach (no `materialization:` block), remove this function and implement ingestion
-# as a standard Python script instead.
-def materialize():
+def probe(source_url: str) -> str | None:
+    """HEAD source_url; return its ETag ("" if none is sent), or None if the month is not published (403/404)."""
+    head = SESSION.head(source_url, timeout=(5, 10))
+    if head.status_code in (403, 404):
+        return None
+    head.raise_for_status()
+    return head.headers.get("ETag", "").removeprefix("W/").strip('"')
+
+
+def cached_download(source_url: str, etag: str) -> Path | None:
+    """
+    Return a local copy of source_url under CACHE_DIR keyed by the ETag from probe(), or None
+    if the download is refused. Already-cached months are not fetched again.
+    """
+    name = source_url.rsplit("/", 1)[-1].removesuffix(".parquet")
+    cache_path = CACHE_DIR / (f"{name}-{etag}.parquet" if etag else f"{name}.parquet")
+    if etag and cache_path.exists():
+        return cache_path
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = cache_path.with_name(cache_path.name + ".tmp")
+    try:
+        with SESSION.get(source_url, stream=True, timeout=(5, 120)) as response:
+            if response.status_code != 200:
+                return None
+            with open(tmp, "wb") as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+        os.replace(tmp, cache_path)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return cache_path
+
+
+def read_month(path: Path) -> pa.Table:
+    """Read one cached monthly file, projected to and aligned with EXPECTED_SCHEMA."""
+    # Parse the footer once and reuse it both to plan the projection and to read row groups.
+    parquet_file = pq.ParquetFile(path, memory_map=True, pre_buffer=True)
+    available = set(parquet_file.schema_arrow.names)
+    wanted = [column for column in EXPECTED_RAW_COLUMNS if column in available]
+    missing = [field for field in EXPECTED_SCHEMA if field.name not in available]
+
+    table = parquet_file.read(columns=wanted, use_threads=True)
+    for field in missing:
+        table = table.append_column(field, pa.nulls(table.num_rows, type=field.type))
+    return table
+
+
+def create_trips_table(con: duckdb.DuckDBPyConnection) -> None:
+    """Create ingestion.trips from EXPECTED_SCHEMA + LINEAGE_FIELDS, so the DDL cannot drift from read_month()."""
+    con.execute("CREATE SCHEMA IF NOT EXISTS ingestion")
+    empty = pa.schema(list(EXPECTED_SCHEMA) + LINEAGE_FIELDS).empty_table()
+    con.register("trips_schema", empty)
+    con.execute("CREATE TABLE IF NOT EXISTS ingestion.trips AS SELECT * FROM trips_schema LIMIT 0")
+    con.unregister("trips_schema")
+
+
+def ingest():
     """
-    TODO: Implement ingestion using Bruin runtime context.
+    Ingest the run window into ingestion.trips using Bruin runtime context.
 
-    Required Bruin concepts to use here:
-    - Built-in date window variables:
-      - BRUIN_START_DATE / BRUIN_END_DATE (YYYY-MM-DD)
-      - BRUIN_START_DATETIME / BRUIN_END_DATETIME (ISO datetime)
+    - BRUIN_START_DATE / BRUIN_END_DATE (YYYY-MM-DD) pick the months to load.
       Docs: https://getbruin.com/docs/bruin/assets/python#environment-variables
-    - Pipeline variables:
-      - Read JSON from BRUIN_VARS, e.g. `taxi_types`
+    - BRUIN_VARS carries pipeline variables, e.g. `taxi_types`.
       Docs: https://getbruin.com/docs/bruin/getting-started/pipeline-variables
 
-    Design TODOs (keep logic minimal, focus on architecture):
-    - Use start/end dates + `taxi_types` to generate a list of source endpoints for the run window.
-    - Fetch data for each endpoint, parse into DataFrames, and concatenate.
-    - Add a column like `extracted_at` for lineage/debugging (timestamp of extraction).
-    - Prefer append-only in ingestion; handle duplicates in staging.
+    Months are HEAD-probed and downloaded on a thread pool; each finished month is read, aligned to
+    EXPECTED_SCHEMA and appended (with taxi_type / source_url / extracted_at lineage) before the next.
+    The whole window is appended in one transaction (all-or-nothing, like Bruin materialization);
+    ingestion is append-only and duplicates are handled in staging.
     """
     start_date = parser.parse(os.environ["BRUIN_START_DATE"])
     end_date = parser.parse(os.environ["BRUIN_END_DATE"])
     vars_payload = json.loads(os.environ.get("BRUIN_VARS", "{}"))
     taxi_types = vars_payload.get("taxi_types", DEFAULT_TAXI_TYPES)
 
-    extraction_ts = datetime.now(timezone.utc).isoformat()
-    all_frames = []
-
-    for month_start in month_starts(start_date=start_date, end_date=end_date):
-        month_label = month_start.strftime("%Y-%m")
-        for taxi_type in taxi_types:
-            source_url = f"{BASE_URL}/{taxi_type}_tripdata_{month_label}.parquet"
-            response = requests.get(source_url, timeout=120)
-            if response.status_code != 200:
-                continue
-
-            frame = pd.read_parquet(io.BytesIO(response.content))
-            for column in EXPECTED_RAW_COLUMNS:
-                if column not in frame.columns:
-                    frame[column] = pd.NA
-            frame["taxi_type"] = taxi_type
-            frame["source_url"] = source_url
-            frame["extracted_at"] = extraction_ts
-            all_frames.append(frame)
-
-    if not all_frames:
-        return pd.DataFrame(columns=["taxi_type", "source_url", "extracted_at"])
-
-    return pd.concat(all_frames, ignore_index=True)
+    extraction_ts = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    sources = [
+        (taxi_type, f"{BASE_URL}/{taxi_type}_tripdata_{month_start.strftime('%Y-%m')}.parquet")
+        for month_start in month_starts(start_date=start_date, end_date=end_date)
+        for taxi_type in taxi_types
+    ]
+
+    con = duckdb.connect(json.loads(os.environ["DUCKDB_DEFAULT"])["path"])
+    try:
+        create_trips_table(con)
+        # One transaction for the whole window: a failed month rolls back the earlier ones too,
+        # so a failed Bruin run never leaves partial data behind for the re-run to append again.
+        con.begin()
+        # Workers only probe and download into the cache; reading and inserting happen here one month at a time.
+        with ThreadPoolExecutor(max_workers=max(1, min(MAX_DOWNLOAD_WORKERS, len(sources)))) as ex:
+            # Cheap HEADs first, so months that are not published yet never cost a GET.
+            etags = list(ex.map(probe, [source_url for _, source_url in sources]))
+            futures = {
+                ex.submit(cached_download, source_url, etag): (taxi_type, source_url)
+                for (taxi_type, source_url), etag in zip(sources, etags)
+                if etag is not None
+            }
+            for future in as_completed(futures):
+                taxi_type, source_url = futures[future]
+                path = future.result()
+                if path is None:
+                    continue
+
+                month = read_month(path)
+                con.register("month", month)
+                con.execute(
+                    "INSERT INTO ingestion.trips BY NAME "
+                    "SELECT *, ? AS taxi_type, ? AS source_url, ? AS extracted_at FROM month",
+                    [taxi_type, source_url, extraction_ts],
+                )
+                con.unregister("month")
+                print(f"Loaded {month.num_rows} rows from {source_url}")
+
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    ingest()